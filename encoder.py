@@ -1,9 +1,13 @@
 import RPi.GPIO as GPIO
 import alsaaudio
-import subprocess
+import logging
+import queue
+import time
 
-from datetime import datetime, timedelta
 from luma.core.render import canvas
+from widgetFactory import measure_text
+
+logger = logging.getLogger(__name__)
 
 class Encoder:
 
@@ -28,8 +32,14 @@ class Encoder:
         elif rotaryFunction == "audioFile":
             # on startup, use the filename specified first in the config.
             self.value = 0
+            # the list of audio files comes from the config and doesn't change at runtime.
+            self.audioFileCount = len(getattr(self.state_tracker, 'doorbell_audioFiles', []))
         
-        print(f"[encoder][init] assigned function for rotary: {self.rotaryFunction}, switch: {self.swFunction}. Initial value: {self.value}")
+        # resolve the assigned functions to their handlers once, rather than comparing function names on every step or click.
+        self.rotaryHandler = {"volume": self.rotaryVolume, "audioFile": self.rotaryAudioFile}.get(rotaryFunction)
+        self.swHandler = {"mute": self.swMute, "amoledToggle": self.swAmoledToggle}.get(swFunction)
+
+        logger.info("[encoder][init] assigned function for rotary: %s, switch: %s. Initial value: %s", self.rotaryFunction, self.swFunction, self.value)
 
         GPIO.setup(self.leftPin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
         GPIO.setup(self.rightPin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
@@ -40,7 +50,7 @@ class Encoder:
         GPIO.add_event_detect(self.swPin, GPIO.FALLING, callback=self.swClicked, bouncetime=300)
 
     # Triggered when the GPIO state changes for the rotary pins. This determines the new state and thus the new value for the rotary encoder.
-    # Once we land on a new value, pass the assigned action for the encoder and the current value to the rotary action function.
+    # Once we land on a new value, run the rotary action for the assigned function.
     def transitionOccurred(self, channel):
         p1 = GPIO.input(self.leftPin)
         p2 = GPIO.input(self.rightPin)
@@ -57,16 +67,14 @@ class Encoder:
                 self.direction = "R"
             elif newState == "00": # Turned left 1
                 if self.direction == "L":
-                    self.value = self.value - 1
-                    self.rotaryAction(self.rotaryFunction,self.value)
+                    self.step(-1)
 
         elif self.state == "10": # R3 or L1
             if newState == "11": # Turned left 1
                 self.direction = "L"
             elif newState == "00": # Turned right 1
                 if self.direction == "R":
-                    self.value = self.value + 1
-                    self.rotaryAction(self.rotaryFunction,self.value)
+                    self.step(1)
 
         else: # self.state == "11"
             if newState == "01": # Turned left 1
@@ -75,111 +83,134 @@ class Encoder:
                 self.direction = "R"
             elif newState == "00": # Skipped an intermediate 01 or 10 state, but if we know direction then a turn is complete
                 if self.direction == "L":
-                    self.value = self.value - 1
-                    self.rotaryAction(self.rotaryFunction,self.value)
+                    self.step(-1)
                 elif self.direction == "R":
-                    self.value = self.value + 1
-                    self.rotaryAction(self.rotaryFunction,self.value)
+                    self.step(1)
                 
         self.state = newState
 
+    # A full detent was completed in the given direction (-1 left, +1 right).
+    def step(self, delta):
+        self.value = self.value + delta
+        self.rotaryAction()
+
     # Triggered when the GPIO falling signal is detected, indicating that the switch was pushed. Pass the assigned action to the switch action function.
     def swClicked(self, channel):
-        self.swAction(self.swFunction)
+        self.swAction()
     
-    def rotaryAction(self, rotaryFunction, value):
-        self.rotaryFunction = rotaryFunction
-        self.value = value
+    def rotaryAction(self):
         self.oled_text = False
 
-        print(f"[encoder][rotaryAction] triggered {self.rotaryFunction} action, value: {self.value}")
-        # reset the number of cycles that the main thread will run through, before restoring the display.
-        self.state_tracker.controlsLockCycles = 40
-
-        if self.rotaryFunction == "volume":
-            # check that the master volume is not muted.
-            if self.mixer.getmute()[0] == 0:
-                # check valid range and cap the value if invalid.
-                if self.value < 0:
-                    self.value = 0
-                elif self.value > 100:
-                    self.value = 100
-
-                # set the new volume.
-                self.mixer.setvolume(self.value)
-                self.oled_text = "Volume: " + str(self.value)
-            
-            else: # muted.
-                self.oled_text = "MUTE"
-        
-        if self.rotaryFunction == "audioFile":
-            # keep the value within valid range (number of files defined in config).
-            print(f"{len(self.state_tracker.doorbell_audioFiles)} audio files available")
-            if self.value < 0:
-                self.value = 0
-            if self.value >= len(self.state_tracker.doorbell_audioFiles):
-                self.value = len(self.state_tracker.doorbell_audioFiles) - 1
-            
-            self.state_tracker.doorbell_currentAudioFile = self.value
-            self.oled_text = self.state_tracker.doorbell_audioFiles[self.state_tracker.doorbell_currentAudioFile].rsplit("/")[-1]
+        logger.debug("[encoder][rotaryAction] triggered %s action, value: %s", self.rotaryFunction, self.value)
+        # hold the display for a moment before the main thread restores it.
+        self.state_tracker.controlsLockDeadline = time.monotonic() + 0.5
+
+        if self.rotaryHandler:
+            self.rotaryHandler()
 
         # Display the result of this action on the OLED, if it is enabled.
         if self.state_tracker.oled_enabled and self.oled_text:
-            # reset the number of cycles that the main thread will run through, before restoring the display.
-            self.state_tracker.controlsLockCycles = 400
-            print(f"[encoder][{self.rotaryFunction}] {self.oled_text}")
-            self.device.clear()
-            with canvas(self.device) as draw:
-                self.oled_font = self.state_tracker.oled_default_font
-                self.text_w, self.text_h = draw.textsize(self.oled_text,self.state_tracker.oled_default_font)
-                if self.text_w > self.device.width:
-                    # shrink the text
-                    self.oled_font = self.state_tracker.oled_small_font
-                    self.text_w, self.text_h = draw.textsize(self.oled_text,self.state_tracker.oled_small_font)
-
-                self.text_x = (self.device.width / 2) - (self.text_w / 2)
-                self.text_y = (self.device.height / 2) - (self.text_h / 2)
-                draw.text((self.text_x,self.text_y), text=self.oled_text, font=self.oled_font, fill="white")
-
-    def swAction(self, swFunction):
-        self.swFunction = swFunction
+            # keep the result on screen for a few seconds before the main thread restores the display.
+            self.state_tracker.controlsLockDeadline = time.monotonic() + 5
+            logger.debug("[encoder][%s] %s", self.rotaryFunction, self.oled_text)
+            self.showText(self.oled_text)
+
+    def swAction(self):
         self.oled_text = False
 
-        print(f"[encoder][swAction] triggered {self.swFunction} action")
+        logger.debug("[encoder][swAction] triggered %s action", self.swFunction)
         
-        # reset the number of cycles that the main thread will run through, before restoring the display.
-        self.state_tracker.controlsLockCycles = 400
+        # keep the result on screen for a few seconds before the main thread restores the display.
+        self.state_tracker.controlsLockDeadline = time.monotonic() + 5
 
-        if self.swFunction == "mute":
-            if self.mixer.getmute()[0] == 0:
-                self.mixer.setmute(1)
-                self.oled_text = "MUTE ON"
-            else:
-                self.mixer.setmute(0)
-                self.value = self.mixer.getvolume()[0]
-                self.oled_text = "Volume: " + str(self.value)
-        
-        if self.swFunction == "amoledToggle":
-            if self.state_tracker.amoled_enabled:
-                if self.state_tracker.amoled.display_power_state(self.state_tracker.amoled_display_id) == "on":
-                    self.state_tracker.amoled.display_power_off(self.state_tracker.amoled_display_id)
-                else:
-                    self.oled_text = "One sec, getting feed..."
-                    
-                    self.state_tracker.amoled.display_power_on(self.state_tracker.amoled_display_id)
+        if self.swHandler:
+            self.swHandler()
 
         # Display the result of this action on the OLED, if it is enabled.
         if self.state_tracker.oled_enabled and self.oled_text:
-            # clear the oled display and temporarily use it to show the controls action.            
-            self.device.clear()
-            with canvas(self.device) as draw:
-                self.oled_font = self.state_tracker.oled_default_font
-                self.text_w, self.text_h = draw.textsize(self.oled_text,self.state_tracker.oled_default_font)
-                if self.text_w > self.device.width:
-                    # shrink the text
-                    self.oled_font = self.state_tracker.oled_small_font
-                    self.text_w, self.text_h = draw.textsize(self.oled_text,self.state_tracker.oled_small_font)
-
-                self.text_x = (self.device.width / 2) - (self.text_w / 2)
-                self.text_y = (self.device.height / 2) - (self.text_h / 2)
-                draw.text((self.text_x,self.text_y), text=self.oled_text, font=self.oled_font, fill="white")
+            # temporarily use the oled display to show the controls action.
+            self.showText(self.oled_text)
+
+    # Rotary function: master volume.
+    def rotaryVolume(self):
+        # check that the master volume is not muted.
+        if self.mixer.getmute()[0] == 0:
+            # check valid range and cap the value if invalid.
+            if self.value < 0:
+                self.value = 0
+            elif self.value > 100:
+                self.value = 100
+
+            # set the new volume.
+            self.mixer.setvolume(self.value)
+            self.oled_text = "Volume: " + str(self.value)
+        
+        else: # muted.
+            self.oled_text = "MUTE"
+
+    # Rotary function: select the doorbell audio file.
+    def rotaryAudioFile(self):
+        if not self.audioFileCount:
+            return
+
+        # keep the value within valid range (number of files defined in config).
+        if self.value < 0:
+            self.value = 0
+        if self.value >= self.audioFileCount:
+            self.value = self.audioFileCount - 1
+        
+        self.state_tracker.doorbell_currentAudioFile = self.value
+        self.oled_text = self.state_tracker.doorbell_audioFiles[self.state_tracker.doorbell_currentAudioFile].rsplit("/")[-1]
+
+    # Switch function: toggle master mute.
+    def swMute(self):
+        if self.mixer.getmute()[0] == 0:
+            self.mixer.setmute(1)
+            self.oled_text = "MUTE ON"
+        else:
+            self.mixer.setmute(0)
+            self.value = self.mixer.getvolume()[0]
+            self.oled_text = "Volume: " + str(self.value)
+
+    # Switch function: toggle the AMOLED display.
+    def swAmoledToggle(self):
+        if self.state_tracker.amoled_enabled:
+            # query the real power state here, since the display may have been switched outside of smartchime.
+            self.state_tracker.amoled_power_state = self.state_tracker.amoled.display_power_state(self.state_tracker.amoled_display_id)
+            if self.state_tracker.amoled_power_state == "on":
+                self.state_tracker.amoled_power_off()
+            else:
+                self.oled_text = "One sec, getting feed..."
+                
+                self.state_tracker.amoled_power_on()
+
+    # Hand text over to the main loop, which owns the display, instead of drawing from the GPIO callback thread.
+    # Only the latest action matters, so anything not yet drawn is replaced.
+    def showText(self, text):
+        try:
+            self.state_tracker.controls_display.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            self.state_tracker.controls_display.put_nowait(text)
+        except queue.Full:
+            pass
+        self.state_tracker.wakeup.set()
+
+# Draw a line of text centered on the OLED, shrinking it to the small font if it doesn't fit.
+# The canvas starts from a blank frame, so there's no need to clear the device first (which would send an extra frame).
+# The height comes from the font metrics rather than the text, so every string sits on the same baseline.
+def draw_centered_text(device, text, default_font, small_font):
+    with canvas(device) as draw:
+        font = default_font
+        text_w = measure_text(text, default_font)[0]
+        if text_w > device.width:
+            # shrink the text
+            font = small_font
+            text_w = measure_text(text, small_font)[0]
+
+        text_h = sum(font.getmetrics())
+
+        text_x = (device.width / 2) - (text_w / 2)
+        text_y = (device.height / 2) - (text_h / 2)
+        draw.text((text_x,text_y), text=text, font=font, fill="white")
@@ -1,40 +1,32 @@
 import json
 import logging
-import time
+import queue
 import socket
-
-import paho.mqtt.client as mqtt
-import RPi.GPIO as GPIO
+import time
 
 from datetime import datetime
-from dateutil import tz
 from pathlib import Path
 
-from luma.core.interface.serial import spi
-from luma.core.render import canvas
-from luma.core.image_composition import ImageComposition
-from luma.oled.device import ssd1306
+from luma.core.image_composition import ImageComposition, ComposableImage
 from luma.core import cmdline, error
 
-from PIL import ImageFont
-
-from vcgencmd import Vcgencmd
+from PIL import Image, ImageFont
 
 from scroller import Scroller
 from synchronizer import Synchronizer
 from widgetFactory import WidgetFactory
-from encoder import Encoder
 from stateTracker import StateTracker
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)-15s - %(message)s'
-)
+# configure the root logger once, up-front. modules log through their own named loggers.
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(message)s', datefmt='%H:%M:%S'))
+logging.getLogger().addHandler(log_handler)
+logging.getLogger().setLevel(logging.INFO)
+logger = logging.getLogger('smartchime')
 
 def load_config():
-    with open('config.json', 'r') as jsonConfig:
-        data = json.load(jsonConfig)
-        return data
+    # read the whole file in one go and let the C json decoder work on the raw bytes.
+    return json.loads(Path('config.json').read_bytes())
 
 def get_device():
     parser = cmdline.create_parser(description='smartchime.luma')
@@ -47,6 +39,8 @@ def get_device():
     # create device
     try:
         device = cmdline.create_device(args)
+        if args.interface == "spi":
+            logger.info("[main] OLED SPI bus speed: %s Hz", args.spi_bus_speed)
         return device
 
     except error.Error as e:
@@ -76,17 +70,19 @@ try:
     state_tracker.mqtt_enabled = mqtt_config['enabled']
 
     # Set up the AMOLED display.
+    # hardware and network modules are only imported when the function that needs them is enabled.
     if state_tracker.amoled_enabled:
-        print("[main] initializing AMOLED display")
+        logger.info("[main] initializing AMOLED display")
+        from vcgencmd import Vcgencmd
         state_tracker.amoled_always_on = amoled_config['always_on']
         state_tracker.amoled_display_id = amoled_config['display_id']
         state_tracker.amoled = Vcgencmd()
         if state_tracker.amoled_always_on:
-            state_tracker.amoled.display_power_on(state_tracker.amoled_display_id)
+            state_tracker.amoled_power_on()
 
     # Initialize the OLED display.
     if state_tracker.oled_enabled:
-        print("[main] Initializing OLED display")
+        logger.info("[main] Initializing OLED display")
         device = get_device()
         image_composition = ImageComposition(device)
 
@@ -104,16 +100,30 @@ try:
         # END HACK
 
         # initialize OLED layout
-        # row settings that won't change
-        num_rows = len(oled_config['arrangement'][0])
+        # row settings that won't change. resolve them from the config once, so the main loop doesn't have to.
+        arrangement = oled_config['arrangement'][0]
+        num_rows = len(arrangement)
+        clock_format = oled_config['clock'][0]['dateTimeFormat']
+        # unless the clock shows seconds, its text can only change when the minute does. check by formatting two times a second apart,
+        # which catches every spelling of a seconds directive (%S, %-S, %OS, %T, %c, ...).
+        clock_has_seconds = datetime(2000,1,1,0,0,0).strftime(clock_format) != datetime(2000,1,1,0,0,1).strftime(clock_format)
         scrollers = []
 
-        for row in oled_config['arrangement'][0]:
-            vars()[row] = oled_config['arrangement'][0][row]
+        for row in arrangement:
+            vars()[row] = arrangement[row]
             # transform font strings to ImageDraw objects
             vars()[row][0]['iconFont'] = make_font(fonts_config[vars()[row][0]['iconFont']][0]['name'],fonts_config[vars()[row][0]['iconFont']][0]['size'])
             vars()[row][0]['textFont'] = make_font(fonts_config[vars()[row][0]['textFont']][0]['name'],fonts_config[vars()[row][0]['textFont']][0]['size'])
 
+        # the dividers between rows never change, so render them once and keep them in the composition.
+        dividers = []
+        for row in arrangement:
+            row_y = vars()[row][0]['y'] - 2
+            if row_y > 0:
+                divider = ComposableImage(Image.new(device.mode, (device.width, 1), "white"), position=(0, row_y))
+                image_composition.add_image(divider)
+                dividers.append(divider)
+
         # Enable/disable widgets. The clock widget doesn't depend on external data, so to disable it, do not assign it in a column.
         # On the other hand, if other widgets are disabled, their external data will not be pulled in. Placeholder values will be used instead.
         state_tracker.oled_widget_motion_enabled = oled_config['motion'][0]['enabled']
@@ -125,12 +135,15 @@ try:
     
     if state_tracker.mqtt_enabled:
         # set up MQTT client and subscribe to topics/functions that are enabled in config.
-        print("[main] Initializing MQTT connection")
+        logger.info("[main] Initializing MQTT connection")
+        import paho.mqtt.client as mqtt
+        # use a clean session, so the broker doesn't replay events (like a doorbell ring) queued while smartchime was down.
+        # the subscriptions are sent again on every connect.
         mqtt_client = mqtt.Client(socket.getfqdn())
         mqtt_client.username_pw_set(mqtt_config['username'],mqtt_config['password'])
         
         if state_tracker.oled_enabled and state_tracker.oled_widget_message_enabled:
-            print("[main] Initializing OLED message widget")
+            logger.info("[main] Initializing OLED message widget")
             mqtt_client.message_topic = oled_config['message'][0]['topic']
             # initialize the widget with a placeholder value until it is replaced by a real MQTT message.
             state_tracker.message = "smartchime ready for action!"
@@ -140,7 +153,7 @@ try:
             state_tracker.last_message = ""
         
         if state_tracker.oled_enabled and state_tracker.oled_widget_motion_enabled:
-            print("[main] Initializing OLED motion widget")
+            logger.info("[main] Initializing OLED motion widget")
             mqtt_client.motion_topic = oled_config['motion'][0]['topic']
             # initialize the widget with a placeholder value until it is replaced by a real MQTT message.
             state_tracker.last_motion = "---"
@@ -148,9 +161,10 @@ try:
             mqtt_client.motion_topic = False
 
         if state_tracker.doorbell_enabled:
-            print("[main] Initializing doorbell")
+            logger.info("[main] Initializing doorbell")
             mqtt_client.doorbell_topic = doorbell_config['topic']
             state_tracker.doorbell_audioFiles = doorbell_config['audioFiles']
+            state_tracker.doorbell_load_audio()
             state_tracker.doorbell_isBattery = doorbell_config['isBattery']
             state_tracker.doorbell_cameraPlayerArgs = [
                 '--no-osd',
@@ -166,18 +180,26 @@ try:
 
             if state_tracker.amoled_enabled:
                 mqtt_client.camera_topic = amoled_config['topic']
+            else:
+                mqtt_client.camera_topic = False
         else:
             mqtt_client.doorbell_topic = False
             mqtt_client.camera_topic = False
         
+        state_tracker.mqtt_setup_topics(mqtt_client)
         mqtt_client.on_connect=state_tracker.mqtt_on_connect
         mqtt_client.on_subscribe=state_tracker.mqtt_on_subscribe
         mqtt_client.on_message=state_tracker.mqtt_on_message
-        mqtt_client.connect(mqtt_config['address'])
-        mqtt_client.loop_start()
+        # connect in the background rather than blocking startup on the broker. paho retries with backoff if it's unreachable.
+        mqtt_client.reconnect_delay_set(min_delay=1, max_delay=120)
+        mqtt_client.connect_async(mqtt_config['address'])
+        if state_tracker.oled_enabled:
+            mqtt_client.loop_start()
 
     if state_tracker.controls_enabled:
         # set up front panel controls. initial values will be determined in the encoder object.
+        import RPi.GPIO as GPIO
+        from encoder import Encoder, draw_centered_text
         GPIO.setmode(GPIO.BCM)
         renc1 = Encoder(
             controls_config['rotaryEncoder1'][0]['leftPin'], 
@@ -195,25 +217,70 @@ try:
             controls_config['rotaryEncoder2'][0]['switchFunction'],
             state_tracker,
             device)
-
-        state_tracker.controlsLockCycles = 0
         
+    if state_tracker.mqtt_enabled and not state_tracker.oled_enabled:
+        # without the OLED there is nothing for the main loop to animate, so let paho run its network loop
+        # on the main thread instead of spawning a second thread next to an idle polling loop.
+        mqtt_client.loop_forever(retry_first_connection=True)
+
     # Main loop
+    # tick quickly while something on the OLED is moving. otherwise only wake up when the clock is due to change, or when woken by an event.
+    # idle waits are capped at a few seconds, so a step of the wall clock is noticed quickly.
+    tick_interval = 0.0125
+    idle_interval = 5.0
+    timeout = 0
+    next_clock_check = 0
+    # wall clock minus monotonic clock at the last clock check.
+    clock_wall_offset = None
+    # the bytes of the last widget frame sent to the OLED.
+    last_frame = None
     while True:
-        time.sleep(0.0125)
+        state_tracker.wakeup.wait(timeout)
+        state_tracker.wakeup.clear()
+        controls_locked = False
         if state_tracker.controls_enabled:
-            if state_tracker.controlsLockCycles > 0:
-                state_tracker.controlsLockCycles = state_tracker.controlsLockCycles - 1
+            # draw the latest front panel action, if there is one waiting.
+            try:
+                controls_text = state_tracker.controls_display.get_nowait()
+                draw_centered_text(device, controls_text, state_tracker.oled_default_font, state_tracker.oled_small_font)
+                last_frame = None
+            except queue.Empty:
+                pass
+            # the controls hold the display until their deadline passes. the widgets are rebuilt once it's released.
+            if state_tracker.controlsLockDeadline > time.monotonic():
+                controls_locked = True
                 state_tracker.must_refresh = True
 
         # physical controls take precedence over the "normal" widget display, so don't take away the display lock if the controls haven't released it.
-        if state_tracker.oled_enabled and state_tracker.controlsLockCycles == 0:
-            # Advance the scrolling widgets.
+        if state_tracker.oled_enabled and not controls_locked:
+            # trigger an update to the clock widget when the next second or minute (depending on the format) comes around.
+            # time zone offsets are whole minutes, so the epoch minute turns over together with the local one.
+            # the formatted time is kept on the state tracker, so the clock widget doesn't have to format it again.
+            now = time.monotonic()
+            # the wall clock can be stepped (NTP syncing after boot on a Pi without an RTC, or a manual date change).
+            # if it has moved against the monotonic clock since the last check, the deadline is stale, so check again right away.
+            if clock_wall_offset is not None and abs(time.time() - now - clock_wall_offset) > 1.0:
+                next_clock_check = now
+            if now >= next_clock_check:
+                clock_period = 1 if clock_has_seconds else 60
+                wall = time.time()
+                clock_wall_offset = wall - now
+                next_clock_check = now + clock_period - wall % clock_period
+                localTime = datetime.now(state_tracker.local_tz)
+                clockTime = localTime.strftime(clock_format)
+                if clockTime != state_tracker.clock_text:
+                    state_tracker.clock_text = clockTime
+                    state_tracker.must_refresh = True
+
+            # Advance the scrolling widgets. only push a new frame to the device if something actually moved or changed.
+            frame_dirty = False
             for scroller in scrollers:
-                vars()[scroller].tick()
+                if vars()[scroller].tick():
+                    frame_dirty = True
                 
             if state_tracker.must_refresh:
                 state_tracker.must_refresh = False
+                frame_dirty = True
                 # clear the active scrolling widgets and reset the synchronizer.
                 for scroller in scrollers:
                     del vars()[scroller]
@@ -228,16 +295,19 @@ try:
                 #       - 4: right justified.
                 #       - columns 2 and 3 make use of a little extra logic: if both exist, split them evenly across the center of the display. if only one is present, center it.
                 #   - position the widgets (icon + text) according to the x/y coordinates that have been determined.
-                #   - refresh the ImageComposition to make the new positions take effect.
+                #   - the ImageComposition is refreshed once, when the finished frame is drawn below.
                 #   - enable scrolling for widgets that declare as such in their config.
                 r = 0
-                for row in oled_config['arrangement'][0]:
+                for row in arrangement:
                     r += 1
                     row_columns = len(vars()[row][0]['columns'][0])
                     row_y = vars()[row][0]['y']
+                    # widgets on this row sit on a common baseline, spaced evenly between the row's y-coordinate and the bottom of the display.
+                    if row_y > 0:
+                        row_baseline = row_y + (device.height - row_y) / (num_rows - 1) * (r - 1)
                     for col in vars()[row][0]['columns'][0]:
                         widget = vars()[row][0]['columns'][0][col]
-                        print(f"[main][{row}] column {col}: {widget}")
+                        logger.debug("[main][%s] column %s: %s", row, col, widget)
                     
                         vars()[widget] = WidgetFactory(device, image_composition, widget, oled_config[widget][0], vars()[row][0]['iconFont'], vars()[row][0]['textFont'], state_tracker)
 
@@ -257,43 +327,59 @@ try:
                         vars()[widget].text_x += vars()[widget].icon_x
                         
                         if row_y > 0:
-                            s = (device.height - row_y) / (num_rows - 1)
-                            f = [row_y + s * i for i in range(num_rows)]
-                            r2 = r - 1
-                            vars()[widget].icon_y = round(f[r2] - vars()[widget].icon_h) 
-                            vars()[widget].text_y = round(f[r2] - vars()[widget].text_h)
+                            vars()[widget].icon_y = round(row_baseline - vars()[widget].icon_h) 
+                            vars()[widget].text_y = round(row_baseline - vars()[widget].text_h)
                             if vars()[widget].icon_h == 0:
                                 vars()[widget].icon_y = vars()[widget].text_y
                         else:
                             vars()[widget].icon_y = 0
                             vars()[widget].text_y = 0
 
-                        print(f"[main][{row}][{widget}] placement: x: {vars()[widget].icon_x} y: {vars()[widget].icon_y}")
+                        logger.debug("[main][%s][%s] placement: x: %s y: %s", row, widget, vars()[widget].icon_x, vars()[widget].icon_y)
                         vars()[widget].ci_icon.position = (vars()[widget].icon_x, vars()[widget].icon_y)
                         vars()[widget].ci_text.position = (vars()[widget].text_x, vars()[widget].text_y)
-
-                        image_composition.refresh()
                     
                     if vars()[row][0]['scroll']:
                         widget_scroller = widget + "_scroller"
                         scrollers.append(widget_scroller)
-                        vars()[widget_scroller] = Scroller(image_composition,vars()[widget].ci_text,100,synchronizer)
-
-            # Draw the ImageComposition to the device, adding dividers between rows.
-            with canvas(device, background=image_composition()) as draw:
+                        vars()[widget_scroller] = Scroller(image_composition,vars()[widget].ci_text,1.25,synchronizer)
+
+                # keep the dividers on top of the widgets that were just added.
+                for divider in dividers:
+                    image_composition.remove_image(divider)
+                    image_composition.add_image(divider)
+
+            # Draw the ImageComposition to the device. it is already device-sized and includes the row dividers,
+            # so it can be sent as-is instead of being copied into a fresh canvas every frame.
+            # a rebuild can end up with exactly the same pixels (e.g. when the motion text rounds to the same value),
+            # so compare against the last frame before sending it over the bus.
+            if frame_dirty:
                 image_composition.refresh()
-                for row in oled_config['arrangement'][0]:
-                    row_y = vars()[row][0]['y'] - 2
-                    if row_y > 0:
-                        draw.line(((0,row_y),(device.width,row_y)),fill="white",width=1)
+                frame = image_composition().tobytes()
+                if frame != last_frame:
+                    last_frame = frame
+                    device.display(image_composition())
         
-            # trigger an update to the clock widget if necessary.        
-            localTime = datetime.now().astimezone(tz.tzlocal())
-            clockTime = localTime.strftime(oled_config['clock'][0]['dateTimeFormat'])
-            if clockTime != clock.text:
-                state_tracker.must_refresh = True
+
+        # sleep until the next scroll step, the end of the controls lock or the next clock check, whichever comes first.
+        timeout = idle_interval
+        if controls_locked:
+            timeout = min(timeout, max(0, state_tracker.controlsLockDeadline - time.monotonic()))
+        elif state_tracker.oled_enabled:
+            timeout = min(timeout, max(0, next_clock_check - time.monotonic()))
+            for scroller in scrollers:
+                if vars()[scroller].must_scroll:
+                    timeout = min(timeout, tick_interval)
 
 except KeyboardInterrupt:
     pass
 except ValueError as err:
-    print(f"Error: {err}")
+    logger.error("Error: %s", err)
+finally:
+    # release what was set up. each step only runs if startup got far enough to create it.
+    # the luma device clears itself through its own atexit hook.
+    if 'mqtt_client' in vars():
+        mqtt_client.disconnect()
+        mqtt_client.loop_stop()
+    if 'GPIO' in vars():
+        GPIO.cleanup()
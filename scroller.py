@@ -1,4 +1,4 @@
-from luma.core.image_composition import ImageComposition, ComposableImage
+import time
 
 class Scroller():
     WAIT_SCROLL = 1
@@ -6,15 +6,21 @@ class Scroller():
     WAIT_REWIND = 3
     WAIT_SYNC = 4
 
+    # ticked on every pass of the main loop, so keep attribute access on slots rather than an instance dict.
+    __slots__ = ('image_composition', 'speed', 'scroll_start', 'image_x_pos', 'rendered_image', 'max_pos', 'delay', 'wait_until', 'state', 'synchroniser', 'cycles', 'must_scroll')
+
     def __init__(self, image_composition, rendered_image, scroll_delay, synchroniser):
         self.image_composition = image_composition
-        self.speed = 1
+        # pixels per second. the position follows the clock, so the speed doesn't depend on how often the main loop ticks.
+        self.speed = 80
+        self.scroll_start = 0
         self.image_x_pos = 0
         self.rendered_image = rendered_image
         self.image_composition.add_image(rendered_image)
         self.max_pos = rendered_image.width - image_composition().width
+        # seconds to wait before scrolling and before rewinding.
         self.delay = scroll_delay
-        self.ticks = 0
+        self.wait_until = None
         self.state = self.WAIT_SCROLL
         self.synchroniser = synchroniser
         self.render()
@@ -29,10 +35,12 @@ class Scroller():
 
         # Repeats the following sequence:
         #  wait - scroll - wait - rewind -> sync with other scrollers -> wait
+        # Returns True if the visible part of the image moved.
         if self.state == self.WAIT_SCROLL:
             if not self.is_waiting():
                 self.cycles += 1
                 self.state = self.SCROLLING
+                self.scroll_start = time.monotonic()
                 self.synchroniser.busy(self)
 
         elif self.state == self.WAIT_REWIND:
@@ -42,26 +50,36 @@ class Scroller():
 
         elif self.state == self.WAIT_SYNC:
             if self.synchroniser.is_synchronized():
+                self.state = self.WAIT_SCROLL
                 if self.must_scroll:
                     self.image_x_pos = 0
                     self.render()
-                self.state = self.WAIT_SCROLL
+                    return True
 
         elif self.state == self.SCROLLING:
             if self.image_x_pos < self.max_pos:
-                if self.must_scroll:
+                # only render when the position has moved by at least a whole pixel.
+                pos = min(self.max_pos, int((time.monotonic() - self.scroll_start) * self.speed))
+                if pos != self.image_x_pos:
+                    self.image_x_pos = pos
                     self.render()
-                    self.image_x_pos += self.speed
+                    return True
             else:
                 self.state = self.WAIT_REWIND
 
+        return False
+
     def render(self):
         self.rendered_image.offset = (self.image_x_pos, 0)
 
+    # the wait starts on the first check and ends at a fixed monotonic deadline, however often the main loop happens to tick.
     def is_waiting(self):
-        self.ticks += 1
-        if self.ticks > self.delay:
-            self.ticks = 0
+        now = time.monotonic()
+        if self.wait_until is None:
+            self.wait_until = now + self.delay
+            return True
+        if now >= self.wait_until:
+            self.wait_until = None
             return False
         return True
 
@@ -1,107 +1,211 @@
-import json
-import simpleaudio as sa
+import logging
+import queue
+import sys
+import threading
+import wave
 
 from datetime import datetime
-from omxplayer.player import OMXPlayer
-from pathlib import Path
+from dateutil import tz
+from widgetFactory import relative_time
+
+logger = logging.getLogger(__name__)
 
 class StateTracker():
     def __init__(self):
-        self.nextRefresh = datetime.now()
+        self.mqtt_subscriptions = []
+        self.mqtt_topic_handlers = {}
+        self.last_motion = None
+        self.last_motion_time = None
+        # the motion text the OLED currently shows, as last rendered by the motion widget.
+        self.motion_text = None
+        self.doorbellCamPlayer = None
+        self.doorbell_cameraUrl = None
+        self.amoled_power_state = None
+        self.clock_text = None
+        # resolve the local time zone once, rather than every time a local time is needed.
+        self.local_tz = tz.tzlocal()
+        self.messageLock = False
+        self.doorbellLock = False
+        self.controlsLockDeadline = 0
+        # set whenever the display needs attention, so the main loop can sleep while nothing is happening.
+        self.wakeup = threading.Event()
+        self.must_refresh = True
+        # text from the front panel controls, waiting to be drawn by the main loop.
+        self.controls_display = queue.Queue(maxsize=1)
+
+    # vcgencmd forks a process per call, so track the AMOLED power state and only switch it on a real transition.
+    def amoled_power_on(self):
+        if self.amoled_power_state != "on":
+            self.amoled.display_power_on(self.amoled_display_id)
+            self.amoled_power_state = "on"
+
+    def amoled_power_off(self):
+        if self.amoled_power_state != "off":
+            self.amoled.display_power_off(self.amoled_display_id)
+            self.amoled_power_state = "off"
+
+    # Called once during setup, after the enabled topics have been assigned to the client. the topics don't change at runtime,
+    # so the subscription list and topic -> handler map are built here and reused on every (re)connect.
+    def mqtt_setup_topics(self,client):
+        topics = tuple(sys.intern(topic) if topic else topic for topic in (client.message_topic, client.doorbell_topic, client.motion_topic, client.camera_topic))
+        self.mqtt_subscriptions = [(topic, 1) for topic in topics if topic]
+        self.mqtt_subscribed_topics = tuple(topic for topic, qos in self.mqtt_subscriptions)
+        # map each subscribed topic straight to its handler, so on_message does a single lookup per message.
+        handlers = (self.mqtt_on_message_topic, self.mqtt_on_doorbell_topic, self.mqtt_on_motion_topic, self.mqtt_on_camera_topic)
+        self.mqtt_topic_handlers = {topic: handler for topic, handler in zip(topics, handlers) if topic}
+
+    # read the configured doorbell sounds once at startup, so a ring only has to start playback instead of loading the file.
+    # a file that can't be loaded leaves None in its slot, so the indices used by the front panel selection still line up.
+    def doorbell_load_audio(self):
+        # only needed with the doorbell enabled, so it isn't imported at module level.
+        import simpleaudio as sa
+        self.doorbell_waveObjects = []
+        for audioFile in self.doorbell_audioFiles:
+            try:
+                wave_obj = sa.WaveObject.from_wave_file(audioFile)
+            except (OSError, EOFError, ValueError, wave.Error) as err:
+                logger.error("[doorbell] unable to load audio file %s: %s", audioFile, err)
+                wave_obj = None
+            self.doorbell_waveObjects.append(wave_obj)
+
+    def camera_playing(self):
+        if self.doorbellCamPlayer is None:
+            return False
+        # omxplayer (and dbus with it) is only needed with the AMOLED enabled, so it isn't imported at module level.
+        from omxplayer.player import OMXPlayerDeadError
+        # the player process may have exited on its own, in which case it can no longer be queried.
+        try:
+            return self.doorbellCamPlayer.is_playing()
+        except OMXPlayerDeadError:
+            return False
+
+    # the text the motion widget shows: the time since the last motion, or the raw placeholder until a timestamp has been parsed.
+    def motion_display_text(self):
+        if self.last_motion_time is not None:
+            return relative_time(datetime.now(self.local_tz), self.last_motion_time)
+        return self.last_motion
+
+    def camera_quit(self):
+        if self.camera_playing():
+            self.doorbellCamPlayer.quit()
 
     def mqtt_on_connect(self,client,userdata,flags,rc):
         self.mqtt_client = client
         if rc == 0:
-            print(f"[mqtt][on_connect]: connected")
-            if self.mqtt_client.message_topic:
-                self.mqtt_message_topic_subscription = self.mqtt_client.subscribe(self.mqtt_client.message_topic, qos=1)
-            if self.mqtt_client.doorbell_topic:
-                self.mqtt_doorbell_topic_subscription = self.mqtt_client.subscribe(self.mqtt_client.doorbell_topic, qos=1)
-            if self.mqtt_client.motion_topic:
-                self.mqtt_motion_topic_subscription = self.mqtt_client.subscribe(self.mqtt_client.motion_topic, qos=1)
-            if self.mqtt_client.camera_topic:
-                self.mqtt_camera_topic_subscription = self.mqtt_client.subscribe(self.mqtt_client.camera_topic, qos=1)
+            logger.info("[mqtt][on_connect]: connected")
+            # subscribe on every connect, so topic changes in the config take effect and a reconnect gets its subscriptions back.
+            if self.mqtt_subscriptions:
+                self.mqtt_subscription = self.mqtt_client.subscribe(self.mqtt_subscriptions)
         else:
-            print(f"[mqtt][on_connect]: exception connecting to MQTT {self.mqtt_client.connack_string(rc)}")
+            logger.error("[mqtt][on_connect]: exception connecting to MQTT %s", self.mqtt_client.connack_string(rc))
 
     def mqtt_on_subscribe(self,client,userdata,mid,granted_qos):
         self.mqtt_client = client
-        if self.mqtt_client.doorbell_topic and mid == self.mqtt_doorbell_topic_subscription[1]:
-            print(f"[mqtt][on_subscribe]: mid: {mid}, subscribed to {self.mqtt_client.doorbell_topic}")
-        if self.mqtt_client.message_topic and mid == self.mqtt_message_topic_subscription[1]:
-            print(f"[mqtt][on_subscribe]: mid: {mid}, subscribed to {self.mqtt_client.message_topic}")
-        if self.mqtt_client.motion_topic and mid == self.mqtt_motion_topic_subscription[1]:
-            print(f"[mqtt][on_subscribe]: mid: {mid}, subscribed to {self.mqtt_client.motion_topic}")
-        if self.mqtt_client.camera_topic and mid == self.mqtt_camera_topic_subscription[1]:
-            print(f"[mqtt][on_subscribe]: mid: {mid}, subscribed to {self.mqtt_client.camera_topic}")
+        if mid == self.mqtt_subscription[1]:
+            logger.info("[mqtt][on_subscribe]: mid: %s, subscribed to %s", mid, self.mqtt_subscribed_topics)
 
     def mqtt_on_message(self,client,userdata,message):
         self.mqtt_client = client
-        self.must_refresh = True
-        self.messageParse = str(message.payload.decode("utf-8")).split(",")
-        print(f"[mqtt][on_message]: received message from topic {message.topic}: {self.messageParse}")
-        if message.topic == self.mqtt_client.message_topic:
-            self.last_message = str(message.payload.decode("utf-8"))
+        # paho decodes the topic on every access, so read it once.
+        topic = message.topic
+        # look the topic up first, so messages we don't handle are dropped before their payload is decoded.
+        handler = self.mqtt_topic_handlers.get(topic)
+        if handler is None:
+            return
+
+        # decode the payload once. each handler splits out only the fields it needs.
+        payload = message.payload.decode("utf-8")
+        logger.debug("[mqtt][on_message]: received message from topic %s: %s", topic, payload)
+        displayed_message = self.message
+        handler(payload)
+
+        # only rebuild the widgets if the text they show actually changed. repeated events, camera URLs and motion events
+        # that still read the same (e.g. "now") leave the OLED as it is.
+        # wake the main loop once the new state is in place, rather than waiting for its next idle check.
+        if self.message != displayed_message or self.motion_display_text() != self.motion_text:
+            self.must_refresh = True
+            self.wakeup.set()
+
+    def mqtt_on_message_topic(self,payload):
+        self.last_message = payload
+        self.message = self.last_message
+
+    def mqtt_on_motion_topic(self,payload):
+        self.messageParse = payload.split(",")
+        # motion messages are "<state>,<timestamp>". the timestamp is parsed once here, instead of on every refresh of the motion widget.
+        # a malformed timestamp only skips the timestamp update (rather than raising out of paho's network loop); the state is still applied.
+        try:
+            last_motion_time = datetime.strptime(self.messageParse[1],"%Y-%m-%dT%H:%M:%S%z").astimezone(self.local_tz)
+        except (IndexError, ValueError):
+            last_motion_time = None
+            logger.warning("[mqtt][on_message] ignoring malformed motion timestamp")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[mqtt][on_message] raw payload: %r", payload)
+
+        if self.messageParse[0] == "on":
+            
+            # check the message lock. if it is not taken, preserve the existing message string and take the lock until the event clears.
+            if not self.messageLock:
+                self.last_message = self.message
+                self.messageLock = True
+            
+            logger.info("[mqtt][on_message] Motion detected!")
+            self.message = "Motion detected on doorbell camera!"
+
+        if self.messageParse[0] == "off":
+            # release the message lock and restore the previous message.
+            self.messageLock = False
+            logger.info("[mqtt][on_message] Motion event cleared")
             self.message = self.last_message
+            if self.amoled_enabled:
+                self.amoled_power_off()
+                self.camera_quit()
         
-        if message.topic == self.mqtt_client.motion_topic:
-            if self.messageParse[0] == "on":
-                
-                # check the message lock. if it is not taken, preserve the existing message string and take the lock until the event clears.
-                if not self.messageLock:
-                    self.last_message = self.message
-                    self.messageLock = True
-                
-                print(f"[mqtt][on_message] Motion detected!")
-                self.message = "Motion detected on doorbell camera!"
-
-            if self.messageParse[0] == "off":
-                # release the message lock and restore the previous message.
-                self.messageLock = False
-                print(f"[mqtt][on_message] Motion event cleared")
-                self.message = self.last_message
-                if self.amoled_enabled:
-                    self.amoled.display_power_off(self.amoled_display_id)
-                    if 'self.doorbellCamPlayer' in locals():
-                        if self.doorbellCamPlayer.is_playing():
-                            self.doorbellCamPlayer.quit()
-            
-            # update the last motion timestamp
+        # update the last motion timestamp.
+        if last_motion_time is not None:
+            self.last_motion_time = last_motion_time
             self.last_motion = self.messageParse[1]
-        
-        if message.topic == self.mqtt_client.doorbell_topic:
-            if self.messageParse[0] == "on":
-                print(f"[mqtt][on_message] Doorbell ring!")
-
-                # check the message lock. if it is not taken, preserve the existing message string and take the lock until the event clears.
-                if not self.messageLock:
-                    self.last_message = self.message
-                    self.messageLock = True
-
-                # rate limit the doorbell. it's annoying when someone presses the button over and over again.
-                if not self.doorbellLock:
-                    self.doorbellLock = True
-                    self.message = "Someone's at the door!"
-                    wave_obj = sa.WaveObject.from_wave_file(self.doorbell_audioFiles[self.doorbell_currentAudioFile])
+
+    def mqtt_on_doorbell_topic(self,payload):
+        # only the state is used.
+        self.messageParse = payload.split(",", 1)
+        if self.messageParse[0] == "on":
+            logger.info("[mqtt][on_message] Doorbell ring!")
+
+            # check the message lock. if it is not taken, preserve the existing message string and take the lock until the event clears.
+            if not self.messageLock:
+                self.last_message = self.message
+                self.messageLock = True
+
+            # rate limit the doorbell. it's annoying when someone presses the button over and over again.
+            if not self.doorbellLock:
+                self.doorbellLock = True
+                self.message = "Someone's at the door!"
+                wave_obj = self.doorbell_waveObjects[self.doorbell_currentAudioFile]
+                if wave_obj is not None:
                     play_obj = wave_obj.play()
-            
-            if self.messageParse[0] == "off":
-                # once HA indicates the doorbell ring state has cleared, restore the previous message so that we revert the display
-                self.messageLock = False
-                self.doorbellLock = False
-                print("[mqtt][on_message] Doorbell event cleared")
-                self.message = self.last_message
-                if self.amoled_enabled:
-                    self.amoled.display_power_off(self.amoled_display_id)
-                    if 'self.doorbellCamPlayer' in locals():
-                        if self.doorbellCamPlayer.is_playing():
-                            self.doorbellCamPlayer.quit()
         
-        if message.topic == self.mqtt_client.camera_topic:
-            print("[mqtt][on_message] Received new camera video URL")
+        if self.messageParse[0] == "off":
+            # once HA indicates the doorbell ring state has cleared, restore the previous message so that we revert the display
+            self.messageLock = False
+            self.doorbellLock = False
+            logger.info("[mqtt][on_message] Doorbell event cleared")
+            self.message = self.last_message
             if self.amoled_enabled:
-                if 'self.doorbellCamPlayer' in locals():
-                    if self.doorbellCamPlayer.is_playing():
-                        self.doorbellCamPlayer.quit()
-                self.doorbellCamPlayer = OMXPlayer(self.messageParse[0], args=self.doorbell_cameraPlayerArgs)
-                self.amoled.display_power_on(self.amoled_display_id)
\ No newline at end of file
+                self.amoled_power_off()
+                self.camera_quit()
+
+    def mqtt_on_camera_topic(self,payload):
+        # only the stream URL is used.
+        self.messageParse = payload.split(",", 1)
+        logger.info("[mqtt][on_message] Received new camera video URL")
+        if self.amoled_enabled:
+            # the same stream URL can be announced again while it is still playing. keep the running player in that case.
+            if self.messageParse[0] == self.doorbell_cameraUrl and self.camera_playing():
+                self.amoled_power_on()
+                return
+            self.camera_quit()
+            from omxplayer.player import OMXPlayer
+            self.doorbellCamPlayer = OMXPlayer(self.messageParse[0], args=self.doorbell_cameraPlayerArgs)
+            self.doorbell_cameraUrl = self.messageParse[0]
+            self.amoled_power_on()
@@ -1,15 +1,20 @@
 class Synchronizer():
+    __slots__ = ('synchronized', 'busy_count')
+
     def __init__(self):
         self.synchronized = {}
+        # number of tasks currently marked busy, so checking for synchronization doesn't have to walk every task.
+        self.busy_count = 0
 
     def busy(self, task):
+        if self.synchronized.get(id(task), True):
+            self.busy_count += 1
         self.synchronized[id(task)] = False
 
     def ready(self, task):
+        if self.synchronized.get(id(task)) is False:
+            self.busy_count -= 1
         self.synchronized[id(task)] = True
 
     def is_synchronized(self):
-        for task in self.synchronized.items():
-            if task[1] is False:
-                return False
-        return True
\ No newline at end of file
+        return self.busy_count == 0
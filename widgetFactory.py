@@ -1,10 +1,38 @@
-from datetime import datetime
-from dateutil import tz
-from luma.core.image_composition import ImageComposition, ComposableImage
-from luma.core.render import canvas
+import logging
+
+from collections import OrderedDict
+from functools import lru_cache
+from luma.core.image_composition import ComposableImage
 
 from PIL import Image, ImageDraw
 
+logger = logging.getLogger(__name__)
+
+# rendered text images, keyed by text and font. least recently used entries are dropped first.
+RENDER_CACHE_SIZE = 64
+render_cache = OrderedDict()
+
+# rendered icon images (including the padding and separator line), keyed by icon and font. there are only a handful, one per widget.
+icon_cache = {}
+
+# text sizes, keyed by font and string. icons and most widget/controls strings are measured over and over again.
+MEASURE_CACHE_SIZE = 256
+measure_cache = OrderedDict()
+
+# text is measured on a scratch image. measuring through a device canvas would push a blank frame to the display on exit.
+measure_draw = ImageDraw.Draw(Image.new("1", (1,1)))
+
+def measure_text(text, font):
+    key = (id(font), text)
+    size = measure_cache.get(key)
+    if size is None:
+        size = measure_cache[key] = measure_draw.textsize(text, font)
+        if len(measure_cache) > MEASURE_CACHE_SIZE:
+            measure_cache.popitem(last=False)
+    else:
+        measure_cache.move_to_end(key)
+    return size
+
 class WidgetFactory():
     def __init__(self, device, image_composition, widget, widget_config, icon_font, text_font, state_tracker):
         self.device = device
@@ -17,7 +45,7 @@ class WidgetFactory():
         self.refreshWidget()
         self.renderWidget()
         
-        print(f"[widgetFactory][{widget}] adding rendered images to composition")
+        logger.debug("[widgetFactory][%s] adding rendered images to composition", widget)
         self.image_composition.add_image(self.ci_icon)
         self.image_composition.add_image(self.ci_text)
     
@@ -27,36 +55,68 @@ class WidgetFactory():
 
     def refreshWidget(self):
         self.icon = self.widget_config['icon']
-        self.localTime = datetime.now().astimezone(tz.tzlocal())
 
         if self.widget == "clock":
-            self.text = self.localTime.strftime(self.widget_config['dateTimeFormat'])
+            # formatted by the main loop when it checks the time.
+            self.text = self.state_tracker.clock_text
         
         if self.widget == "motion":
-            # ignore initialization/startup case
-            if self.state_tracker.last_motion != "---":
-                dtLast_motion = datetime.strptime(self.state_tracker.last_motion,"%Y-%m-%dT%H:%M:%S%z").astimezone(tz.tzlocal())
-                self.text = relative_time(self.localTime,dtLast_motion)
-            else:
-                self.text = self.state_tracker.last_motion
+            # remember what is on screen, so new motion events only trigger a refresh when this text changes.
+            self.text = self.state_tracker.motion_display_text()
+            self.state_tracker.motion_text = self.text
         
         if self.widget == "message":
             self.text = self.state_tracker.message
 
-        print(f"[refreshwidget][{self.widget}] icon: {self.icon}, text: {self.text}")
+        logger.debug("[refreshwidget][%s] icon: %s, text: %s", self.widget, self.icon, self.text)
 
     def renderWidget(self):
-        with canvas(self.device) as draw:
+        self.icon_padding = 2
+        self.line_padding = 2
+
+        # every widget is rebuilt whenever the layout refreshes, but usually only one of them has new content.
+        # reuse the rendered images for content that has been drawn before. icons come from the config and never change,
+        # so they are cached apart from the text and only drawn once, however often the text next to them changes.
+        icon_key = (self.icon if self.widget_config['icon'] else None, id(self.icon_font), self.device.mode)
+        text_key = (self.text, id(self.text_font), self.device.mode)
+        self.icon_image = icon_cache.get(icon_key)
+        self.text_image = render_cache.get(text_key)
+
+        if self.icon_image is None:
             if self.widget_config['icon']:
-                self.icon_w, self.icon_h = draw.textsize(self.icon, self.icon_font)
+                self.icon_w, self.icon_h = measure_text(self.icon, self.icon_font)
             else:
                 self.icon_w, self.icon_h = (0,0)
 
-            self.text_w, self.text_h = draw.textsize(self.text, self.text_font)
-        
-        self.icon_padding = 2
-        self.line_padding = 2
-        self.icon_w += (self.icon_padding + self.line_padding)
+            self.icon_w += (self.icon_padding + self.line_padding)
+
+            self.icon_image = Image.new(self.device.mode,(self.icon_w,self.icon_h))
+            draw = ImageDraw.Draw(self.icon_image)
+            
+            if self.widget_config['icon']:
+                draw.text((self.line_padding,0), text=self.icon, font=self.icon_font, fill="white")
+                draw.line(((0,0),(0,self.icon_h)),fill="white",width=1)
+            del draw
+
+            icon_cache[icon_key] = self.icon_image
+        else:
+            self.icon_w, self.icon_h = self.icon_image.size
+
+        if self.text_image is None:
+            self.text_w, self.text_h = measure_text(self.text, self.text_font)
+
+            self.text_image = Image.new(self.device.mode,(self.text_w,self.text_h))
+            draw = ImageDraw.Draw(self.text_image)
+            draw.text((0,0), text=self.text, font=self.text_font, fill="white")
+            del draw
+
+            render_cache[text_key] = self.text_image
+            if len(render_cache) > RENDER_CACHE_SIZE:
+                render_cache.popitem(last=False)
+        else:
+            render_cache.move_to_end(text_key)
+            self.text_w, self.text_h = self.text_image.size
+
         self.icon_x = 0
         self.icon_y = 0
         if self.widget_config['icon']:
@@ -69,50 +129,32 @@ class WidgetFactory():
         self.widget_w = self.icon_w + self.text_w
         self.widget_h = max(self.icon_h,self.text_h)
 
-        self.icon_image = Image.new(self.device.mode,(self.icon_w,self.icon_h))
-        draw = ImageDraw.Draw(self.icon_image)
-        
-        if self.widget_config['icon']:
-            draw.text((self.line_padding,0), text=self.icon, font=self.icon_font, fill="white")
-            draw.line(((0,0),(0,self.icon_h)),fill="white",width=1)
         self.ci_icon = ComposableImage(self.icon_image)
-        del draw
-
-
-        self.text_image = Image.new(self.device.mode,(self.text_w,self.text_h))
-        draw = ImageDraw.Draw(self.text_image)
-        draw.text((0,0), text=self.text, font=self.text_font, fill="white")
         self.ci_text = ComposableImage(self.text_image)
-        del draw
 
-        print(f"[renderWidget][{self.widget}] icon x: {self.icon_x}, y: {self.icon_y}, w: {self.icon_w}, h: {self.icon_h}")
-        print(f"[renderWidget][{self.widget}] text x: {self.text_x}, y: {self.text_y}, w: {self.text_w}, h: {self.text_h}")
-        print(f"[renderWidget][{self.widget}] total width: {self.widget_w}, height: {self.widget_h}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[renderWidget][%s] icon x: %s, y: %s, w: %s, h: %s", self.widget, self.icon_x, self.icon_y, self.icon_w, self.icon_h)
+            logger.debug("[renderWidget][%s] text x: %s, y: %s, w: %s, h: %s", self.widget, self.text_x, self.text_y, self.text_w, self.text_h)
+            logger.debug("[renderWidget][%s] total width: %s, height: %s", self.widget, self.widget_w, self.widget_h)
 
 def relative_time(dtlocal,dtcompare):
     # given a datetime object, return a simple, human-readable delta in widget-friendly format.
-    def formatn(n, s):
-        return str(int(n)) + s[0:1]
-
-    def qnr(a, b):
-        return a / b, a % b
-
-    class FormatDelta:
-
-        def __init__(self, dtlocal, dtcompare):
-            delta = dtlocal - dtcompare
-            self.day = delta.days
-            self.second = delta.seconds
-            self.year, self.day = qnr(self.day, 365)
-            self.month, self.day = qnr(self.day, 30)
-            self.hour, self.second = qnr(self.second, 3600)
-            self.minute, self.second = qnr(self.second, 60)
-
-        def format(self):
-            for period in ['year', 'month', 'day', 'hour', 'minute', 'second']:
-                n = getattr(self, period)
-                if n >= 1:
-                    return '{0}'.format(formatn(n, period))
-            return "now"
-
-    return FormatDelta(dtlocal,dtcompare).format()
\ No newline at end of file
+    delta = dtlocal - dtcompare
+    # only the largest unit is shown, so the seconds only matter within the first minute. past that, round down to the minute
+    # so that repeated refreshes hit the cache.
+    seconds = delta.seconds
+    if delta.days != 0 or seconds >= 60:
+        seconds -= seconds % 60
+    return format_delta(delta.days, seconds)
+
+@lru_cache(maxsize=256)
+def format_delta(days, seconds):
+    # only the largest non-zero unit is shown, e.g. "3d" or "5m" (months and minutes share the "m").
+    years, days = divmod(days, 365)
+    months, days = divmod(days, 30)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    for n, unit in ((years, 'y'), (months, 'm'), (days, 'd'), (hours, 'h'), (minutes, 'm'), (seconds, 's')):
+        if n >= 1:
+            return f"{n}{unit}"
+    return "now"